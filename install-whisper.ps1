@@ -994,8 +994,13 @@ function Install-Dependencies {
             "faster-whisper",
             "pydantic",
             "python-multipart",
+            "orjson",
             "numpy",
             "soundfile",
+            "librosa",
+            "psutil",
+            "blake3",
+            "cachetools",
             "pywin32"
         )
 
@@ -1,12 +1,76 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+import os
+import glob
+import psutil
+
+def parse_cpu_list(text):
+    """Parse a sysfs CPU list such as "0-3,8" into a set of ids"""
+    cpus = set()
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def physical_core_ids(allowed):
+    """One allowed logical CPU per physical core (Linux sysfs topology)
+
+    Cores with no sibling in the allowed set (e.g. excluded by a cpuset) are skipped.
+    """
+    sibling_groups = set()
+    for path in glob.glob("/sys/devices/system/cpu/cpu[0-9]*/topology/thread_siblings_list"):
+        with open(path) as f:
+            sibling_groups.add(frozenset(parse_cpu_list(f.read())))
+    cpus = set()
+    for siblings in sibling_groups:
+        usable = siblings & allowed
+        if usable:
+            cpus.add(min(usable))
+    return cpus
+
+def count_physical_cores():
+    """Physical cores this process may run on (respects cpusets/affinity on Linux)"""
+    host_cores = psutil.cpu_count(logical=False) or 4
+    if not hasattr(os, "sched_getaffinity"):
+        return host_cores
+    allowed = os.sched_getaffinity(0)
+    try:
+        cpus = physical_core_ids(allowed)
+    except (OSError, ValueError):
+        cpus = set()
+    return len(cpus) if cpus else min(host_cores, len(allowed))
+
+# OpenMP/MKL read their thread counts when the runtime loads, so these must be
+# set before ctranslate2/torch are imported. Default to one thread per physical
+# core; SMT siblings only add contention for int8 GEMMs.
+PHYSICAL_CORES = count_physical_cores()
+CPU_THREADS = int(os.getenv("WHISPER_CPU_THREADS", str(PHYSICAL_CORES)))
+NUM_WORKERS = int(os.getenv("WHISPER_NUM_WORKERS", "1"))
+os.environ.setdefault("OMP_NUM_THREADS", str(CPU_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(CPU_THREADS))
+
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
-from faster_whisper import WhisperModel
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+from faster_whisper import WhisperModel, decode_audio
+from blake3 import blake3
+from cachetools import LRUCache
+from contextlib import asynccontextmanager
+from operator import attrgetter
 from typing import Optional
+import numpy as np
+import orjson
+import soundfile as sf
+import librosa
 import asyncio
-import tempfile
+import bisect
+import concurrent.futures
+import functools
+import io
+import sys
+import threading
+import ctranslate2
 import torch
-import os
 import uvicorn
 import logging
 
@@ -15,12 +79,15 @@ import logging
 # -----------------------------
 MODEL_SIZE = os.getenv("WHISPER_MODEL", "small")
 
+SAMPLE_RATE = 16000  # Whisper expects 16kHz mono float32
+
 # File upload limits
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100 MB
-ALLOWED_AUDIO_EXTENSIONS = {
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Uploads are read 1 MB at a time
+ALLOWED_AUDIO_EXTENSIONS = frozenset({
     ".mp3", ".mp4", ".mpeg", ".mpga", ".m4a",
     ".wav", ".webm", ".ogg", ".flac", ".opus"
-}
+})
 
 # Logging
 logging.basicConfig(
@@ -29,81 +96,457 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Auto-detect CUDA availability and check for modern GPUs
-DEVICE = "cpu"
-COMPUTE_TYPE = "int8"
+# Preferred CTranslate2 compute types, best first. Mixed int8 types keep int8
+# weights but accumulate in a wider float type (AMX/VNNI CPUs, Turing+ GPUs)
+COMPUTE_TYPE_PREFERENCES = {
+    "cuda": ("int8_float16", "float16", "float32"),
+    "cpu": ("int8_bfloat16", "int8_float32", "int8"),
+}
 
-# Use print to ensure logs appear during module import (before uvicorn captures logging)
-print("="*60)
-print("Whisper API Server - GPU Detection")
-print("="*60)
+def select_compute_type(device, device_index=0):
+    """Pick the best compute type supported by this device (WHISPER_COMPUTE_TYPE overrides)"""
+    override = os.getenv("WHISPER_COMPUTE_TYPE")
+    try:
+        supported = ctranslate2.get_supported_compute_types(device, device_index)
+    except Exception as e:
+        print(f"✗ Could not query supported compute types for {device}: {e}")
+        supported = set()
+
+    if override:
+        # "auto"/"default" are resolved by CTranslate2 itself; without a supported
+        # set to check against, trust the operator
+        if override in ("auto", "default") or not supported or override in supported:
+            return override
+        print(f"✗ WHISPER_COMPUTE_TYPE={override} is not supported on {device} "
+              f"(supported: {', '.join(sorted(supported))}), picking automatically")
+
+    for compute_type in COMPUTE_TYPE_PREFERENCES[device]:
+        if compute_type in supported:
+            return compute_type
+    return COMPUTE_TYPE_PREFERENCES[device][-1]
+
+# PyTorch 2.9+ requires compute capability >= 7.5 (sm_75)
+# Older versions support down to 5.0 or 6.0
+PYTORCH_MIN_CAPABILITY = (7, 5)
+
+GPU_ARCHITECTURES = (
+    ((9, 0), "Hopper (2022+)"),
+    ((8, 9), "Ada Lovelace (2022)"),
+    ((8, 0), "Ampere (2020)"),
+    ((7, 5), "Turing (2018)"),
+    ((7, 0), "Volta (2017)"),
+    ((6, 0), "Pascal (2016)"),
+    ((5, 0), "Maxwell (2014)"),
+)
 
-if torch.cuda.is_available():
-    print("✓ CUDA is available on this system")
+def gpu_architecture(capability):
+    """Map a (major, minor) compute capability to its architecture name"""
+    for min_capability, arch in GPU_ARCHITECTURES:
+        if capability >= min_capability:
+            return arch
+    return "Kepler or older (2012-)"
+
+def detect_device(device_index=0):
+    """Auto-detect CUDA availability and check for modern GPUs.
+
+    Returns (device, compute_type, gpu_info). Uses print to ensure logs appear
+    during module import (before uvicorn captures logging).
+    """
+    device = "cpu"
+    gpu_info = {
+        "cuda_available": torch.cuda.is_available(),
+        "cuda_version": getattr(torch.version, "cuda", None),
+        "pytorch_version": torch.__version__,
+    }
+
+    print("="*60)
+    print("Whisper API Server - GPU Detection")
+    print("="*60)
+
+    if gpu_info["cuda_available"]:
+        print("✓ CUDA is available on this system")
+        try:
+            capability = tuple(torch.cuda.get_device_capability(device_index))
+            sm = f"sm_{capability[0]}{capability[1]}"
+            gpu_info.update(
+                name=torch.cuda.get_device_name(device_index),
+                capability=capability,
+                architecture=gpu_architecture(capability),
+            )
+
+            print(f"GPU Name: {gpu_info['name']}")
+            print(f"GPU Compute Capability: {sm} ({capability[0]}.{capability[1]})")
+            print(f"CUDA Toolkit Version: {torch.version.cuda}")
+            print(f"PyTorch Version: {torch.__version__}")
+            print(f"PyTorch Minimum Required: sm_75 (7.5+)")
+
+            if capability < PYTORCH_MIN_CAPABILITY:
+                gpu_info["reason"] = "GPU incompatible with PyTorch version"
+                print(f"✗ GPU INCOMPATIBLE: Your GPU ({sm}) is below PyTorch minimum (sm_75)")
+                print(f"   Explanation: PyTorch {torch.__version__} dropped support for older GPUs")
+                print(f"   - Your GPU: {gpu_info['architecture']} architecture")
+                print(f"   - Required: Compute Capability 7.5+ (Turing/Volta/Ampere/Ada/Hopper)")
+                print(f"   - Supported GPUs: RTX 20/30/40 series, Tesla V100+, A100, H100")
+                print(f"")
+                print(f"   To use this GPU, you would need to downgrade PyTorch to version 2.4 or earlier.")
+                print(f"   Current configuration will use CPU mode (int8 quantization).")
+            else:
+                device = "cuda"
+                print(f"✓ GPU COMPATIBLE: Compute capability {capability[0]}.{capability[1]} meets PyTorch requirement (7.5+)")
+                print(f"✓ CUDA ACCELERATION ENABLED")
+
+        except Exception as e:
+            gpu_info["reason"] = f"GPU detection failed: {e}"
+            print(f"✗ Could not get GPU information: {e}")
+    else:
+        gpu_info["reason"] = "no CUDA support"
+        print("✗ CUDA is NOT available on this system")
+        print("   Possible reasons:")
+        print("   - No NVIDIA GPU detected")
+        print("   - NVIDIA drivers not installed")
+        print("   - PyTorch CPU-only version installed")
+
+    if device == "cuda":
+        print(f"Final Device: CUDA (GPU acceleration active)")
+    else:
+        print(f"Final Device: CPU ({gpu_info['reason']})")
+
+    return device, select_compute_type(device, device_index), gpu_info
+
+def configure_torch_cuda():
+    """Enable TF32 tensor cores, cuDNN autotuning and fused attention kernels.
+
+    CTranslate2 runs its own CUDA kernels, so these only affect code paths that
+    go through PyTorch. The mel input shape is fixed, so cuDNN benchmark caching is safe.
+    """
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.enable_flash_sdp(True)
+    torch.backends.cuda.enable_mem_efficient_sdp(True)
+
+def pin_to_physical_cores():
+    """Restrict the process to one hardware thread per physical core to avoid SMT thrash.
+
+    Threads inherit the affinity of their creator, so this must run before the
+    inference thread pools are spawned. No-op outside Linux.
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        return
     try:
-        capability = torch.cuda.get_device_capability(0)
-        compute_cap = float(f"{capability[0]}.{capability[1]}")
-        gpu_name = torch.cuda.get_device_name(0)
-
-        print(f"GPU Name: {gpu_name}")
-        print(f"GPU Compute Capability: sm_{capability[0]}{capability[1]} ({compute_cap})")
-        print(f"CUDA Toolkit Version: {torch.version.cuda}")
-        print(f"PyTorch Version: {torch.__version__}")
-
-        # Check PyTorch compatibility
-        # PyTorch 2.9+ requires compute capability >= 7.5 (sm_75)
-        # Older versions support down to 5.0 or 6.0
-        pytorch_min_capability = 7.5  # PyTorch 2.9.x minimum requirement
-
-        print(f"PyTorch Minimum Required: sm_75 (7.5+)")
-
-        if compute_cap < pytorch_min_capability:
-            print(f"✗ GPU INCOMPATIBLE: Your GPU (sm_{capability[0]}{capability[1]}) is below PyTorch minimum (sm_75)")
-            print(f"   Explanation: PyTorch {torch.__version__} dropped support for older GPUs")
-            print(f"   - Your GPU: Compute Capability {compute_cap} (Pascal/Maxwell architecture)")
-            print(f"   - Required: Compute Capability 7.5+ (Turing/Volta/Ampere/Ada/Hopper)")
-            print(f"   - Supported GPUs: RTX 20/30/40 series, Tesla V100+, A100, H100")
-            print(f"")
-            print(f"   To use this GPU, you would need to downgrade PyTorch to version 2.4 or earlier.")
-            print(f"   Current configuration will use CPU mode (int8 precision).")
-            print(f"Final Device: CPU (GPU incompatible with PyTorch version)")
-        elif compute_cap >= 5.0:
-            # GPU is compatible, enable CUDA
-            DEVICE = "cuda"
-            COMPUTE_TYPE = "float16"
-            print(f"✓ GPU COMPATIBLE: Compute capability {compute_cap} meets PyTorch requirement (7.5+)")
-            print(f"✓ CUDA ACCELERATION ENABLED")
-            print(f"Final Device: CUDA (GPU acceleration active with float16 precision)")
-        else:
-            print(f"✗ GPU TOO OLD: Compute capability {compute_cap} < 5.0")
-            print(f"   This GPU is from pre-2014 era and is not supported by any modern CUDA toolkit.")
-            print(f"Final Device: CPU (GPU too old)")
+        allowed = os.sched_getaffinity(0)
+        cpus = physical_core_ids(allowed)
+        if cpus and cpus != allowed:
+            os.sched_setaffinity(0, cpus)
+            print(f"Pinned to {len(cpus)} physical cores: {sorted(cpus)}")
+    except (OSError, ValueError) as e:
+        print(f"✗ Could not set CPU affinity: {e}")
 
-    except Exception as e:
-        print(f"✗ Could not get GPU information: {e}")
-        print(f"Final Device: CPU (GPU detection failed)")
+DEVICE_INDEX = int(os.getenv("CUDA_DEVICE_ID", "0"))
+DEVICE, COMPUTE_TYPE, GPU_INFO = detect_device(DEVICE_INDEX)
+if DEVICE == "cuda":
+    configure_torch_cuda()
 else:
-    print("✗ CUDA is NOT available on this system")
-    print("   Possible reasons:")
-    print("   - No NVIDIA GPU detected")
-    print("   - NVIDIA drivers not installed")
-    print("   - PyTorch CPU-only version installed")
-    print(f"Final Device: CPU (no CUDA support)")
+    pin_to_physical_cores()
 
 print("="*60)
-print(f"Active Configuration: DEVICE={DEVICE}, COMPUTE_TYPE={COMPUTE_TYPE}, MODEL={MODEL_SIZE}")
+print(f"Active Configuration: DEVICE={DEVICE}, COMPUTE_TYPE={COMPUTE_TYPE}, MODEL={MODEL_SIZE}, CPU_THREADS={CPU_THREADS}")
 print("="*60)
 
-DEVICE_INDEX = int(os.getenv("CUDA_DEVICE_ID", "0"))
 CHUNK_LENGTH_S = int(os.getenv("CHUNK_LENGTH", "15"))
 VAD_FILTER = os.getenv("VAD_FILTER", "false").lower() == "true"
 PORT = 4444
 HOST = "127.0.0.1"
 
+# Dynamic batching: jobs already queued when the worker frees up (up to MAX_BATCH)
+# are taken as one batch. Jobs in a batch still run one after another, so waiting
+# for stragglers only adds latency; BATCH_WINDOW_S defaults to no wait
+MAX_BATCH = int(os.getenv("WHISPER_MAX_BATCH", "8"))
+BATCH_WINDOW_S = float(os.getenv("WHISPER_BATCH_WINDOW", "0"))
+BATCH_BUCKETS = (10.0, 30.0, 60.0)  # Duration bucket edges in seconds
+
+# VAD costs more than it saves on short clips; on long recordings raise the
+# speech threshold (Silero default 0.5) so more silence is dropped before encoding
+VAD_SKIP_THRESHOLD_S = float(os.getenv("VAD_SKIP_THRESHOLD_S", "3.0"))
+LONG_AUDIO_S = 60.0
+LONG_AUDIO_VAD_THRESHOLD = 0.55
+
+# Recent transcriptions keyed by (blake3 of upload, language, temperature); 0 disables
+CACHE_SIZE = int(os.getenv("WHISPER_CACHE_SIZE", "256"))
+
+TRANSCRIBE_OPTIONS = dict(
+    # Less aggressive duplicate detection:
+    condition_on_previous_text=True,
+    temperature=0.0,                          # Single temperature, no fallback retries
+    beam_size=1,
+    best_of=1,
+    word_timestamps=False,
+    chunk_length=CHUNK_LENGTH_S,
+    vad_filter=True,
+    vad_parameters={
+        "min_speech_duration_ms": 200,
+        "min_silence_duration_ms": 250,
+        "speech_pad_ms": 120
+    }
+)
+
+# -----------------------------
+# Model load
+# -----------------------------
+PREFLIGHT_MODEL = "tiny"  # Small enough to probe CUDA in well under a second
+
+def load_model(model_size, device, compute_type):
+    return WhisperModel(
+        model_size,
+        device=device,
+        device_index=DEVICE_INDEX,
+        compute_type=compute_type,
+        cpu_threads=CPU_THREADS,
+        num_workers=NUM_WORKERS,
+    )
+
+def preflight_device():
+    """Confirm CUDA works with a tiny model before loading the real one, else fall back to CPU"""
+    if DEVICE != "cuda":
+        return
+
+    try:
+        probe = load_model(PREFLIGHT_MODEL, DEVICE, COMPUTE_TYPE)
+        del probe
+        logger.info(f"✓ CUDA preflight passed with {COMPUTE_TYPE}")
+    except OSError as e:
+        # The probe model couldn't be fetched; that says nothing about CUDA.
+        # Must come first: huggingface_hub's LocalEntryNotFoundError (offline,
+        # not cached) subclasses both FileNotFoundError and ValueError
+        logger.warning(f"Could not run CUDA preflight ({e}), loading on CUDA directly")
+    except (RuntimeError, ValueError) as e:
+        # CTranslate2 raises RuntimeError for CUDA/cuDNN failures and ValueError
+        # for unsupported compute types
+        logger.warning(f"CUDA preflight failed: {e}")
+        fall_back_to_cpu(f"CUDA preflight failed: {e}")
+
+def fall_back_to_cpu(reason):
+    """Switch the active device to CPU and re-select the compute type"""
+    global DEVICE, COMPUTE_TYPE
+    logger.info("Falling back to CPU mode...")
+    DEVICE = "cpu"
+    COMPUTE_TYPE = select_compute_type(DEVICE)
+    GPU_INFO["reason"] = reason
+
+def load_whisper_model():
+    """Load MODEL_SIZE on the active device, retrying once on CPU if CUDA fails.
+
+    The tiny preflight model can't tell whether a larger model fits in VRAM.
+    """
+    logger.info(f"Loading Whisper model: {MODEL_SIZE} on {DEVICE} with {COMPUTE_TYPE}")
+    try:
+        model = load_model(MODEL_SIZE, DEVICE, COMPUTE_TYPE)
+    except RuntimeError as e:
+        if DEVICE != "cuda":
+            raise
+        logger.warning(f"Failed to load model with CUDA: {e}")
+        fall_back_to_cpu(f"model failed to load on CUDA: {e}")
+        model = load_model(MODEL_SIZE, DEVICE, COMPUTE_TYPE)
+    logger.info(f"✓ Model loaded successfully: {MODEL_SIZE} on {DEVICE} with {COMPUTE_TYPE}")
+    return model
+
+# -----------------------------
+# Batch scheduler
+# -----------------------------
+_job_queue: Optional[asyncio.Queue] = None
+_batch_worker_task: Optional[asyncio.Task] = None
+
+# Single inference thread: keeps model work off the event loop while the
+# backend parallelizes internally (OpenMP / CUDA)
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="whisper")
+
+# Transcript cache, written from the inference thread and read from the event loop
+_transcript_cache = LRUCache(maxsize=CACHE_SIZE) if CACHE_SIZE > 0 else None
+_transcript_cache_lock = threading.Lock()
+
+def cache_get(key):
+    """Cached (text, language) for key, or None"""
+    if _transcript_cache is None:
+        return None
+    with _transcript_cache_lock:
+        return _transcript_cache.get(key)
+
+def cache_put(key, result):
+    if _transcript_cache is None:
+        return
+    with _transcript_cache_lock:
+        _transcript_cache[key] = result
+
+def decode_audio_buffer(buffer):
+    """Decode an in-memory audio file in-process to a 16kHz mono float32 array"""
+    try:
+        buffer.seek(0)
+        audio, sr = sf.read(buffer, dtype="float32", always_2d=False)
+    except Exception:
+        # Formats libsndfile can't read (m4a, mp4, webm, ...) are decoded by PyAV
+        buffer.seek(0)
+        return decode_audio(buffer, sampling_rate=SAMPLE_RATE)
+
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1)
+    if sr != SAMPLE_RATE:
+        audio = librosa.resample(audio, orig_sr=sr, target_sr=SAMPLE_RATE, res_type="soxr_hq")
+    return audio
+
+def transcribe_options(duration):
+    """TRANSCRIBE_OPTIONS adjusted for the clip duration (seconds)"""
+    if duration <= VAD_SKIP_THRESHOLD_S:
+        return {**TRANSCRIBE_OPTIONS, "vad_filter": False}
+    if duration > LONG_AUDIO_S:
+        vad_parameters = {**TRANSCRIBE_OPTIONS["vad_parameters"], "threshold": LONG_AUDIO_VAD_THRESHOLD}
+        return {**TRANSCRIBE_OPTIONS, "vad_parameters": vad_parameters}
+    return TRANSCRIBE_OPTIONS
+
+# No pinned host staging buffer for CUDA: faster-whisper computes mel features in
+# numpy and CTranslate2 copies them to the device itself. Neither accepts a torch
+# tensor or exposes a pin_memory option, so a pinned buffer would only add a copy.
+def _transcribe(model, audio, on_segment=None, **kwargs):
+    """Run the model and drain the lazy segment generator, returning (text, language)
+
+    on_segment, if given, is called with each segment's text as the decoder yields it.
+    """
+    segments, info = model.transcribe(audio, **kwargs)
+    pieces = []
+    for text in map(attrgetter("text"), segments):
+        piece = text.strip()
+        if not piece:
+            continue
+        pieces.append(piece)
+        if on_segment is not None:
+            on_segment(piece)
+    return " ".join(pieces), info.language
+
+def _resolve(future, result):
+    if future.done():
+        return  # Client went away
+    if isinstance(result, Exception):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+def _finish_job(loop, job, result):
+    """Hand a job's result back to the event loop (future or segment stream)"""
+    _, _, future, stream, cache_key = job
+    if cache_key is not None and not isinstance(result, Exception):
+        cache_put(cache_key, result)
+    if stream is not None:
+        # None marks a successful end of stream
+        loop.call_soon_threadsafe(stream.put_nowait, result if isinstance(result, Exception) else None)
+    else:
+        loop.call_soon_threadsafe(_resolve, future, result)
+
+def _run_batch(loop, model, jobs):
+    """Transcribe a batch of jobs in the worker thread, shortest duration bucket first"""
+    buckets = {}
+    for job in jobs:
+        bucket = bisect.bisect_left(BATCH_BUCKETS, len(job[0]) / SAMPLE_RATE)
+        buckets.setdefault(bucket, []).append(job)
+
+    for bucket in sorted(buckets):
+        for job in buckets[bucket]:
+            audio, language, _, stream, _ = job
+            on_segment = None
+            if stream is not None:
+                on_segment = functools.partial(loop.call_soon_threadsafe, stream.put_nowait)
+            try:
+                options = transcribe_options(len(audio) / SAMPLE_RATE)
+                result = _transcribe(model, audio, on_segment=on_segment, language=language, **options)
+            except Exception as e:
+                result = e
+            _finish_job(loop, job, result)
+
+async def _batch_worker(app):
+    """Collect queued jobs into batches and run them on the inference thread"""
+    loop = asyncio.get_running_loop()
+    while True:
+        jobs = [await _job_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_S
+        while len(jobs) < MAX_BATCH:
+            try:
+                jobs.append(_job_queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                jobs.append(await asyncio.wait_for(_job_queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+
+        if len(jobs) > 1:
+            logger.info(f"Processing batch of {len(jobs)} transcriptions")
+
+        try:
+            await loop.run_in_executor(executor, _run_batch, loop, app.state.model, jobs)
+        except Exception as e:
+            logger.error(f"Batch transcription failed: {e}", exc_info=True)
+            for job in jobs:
+                _finish_job(loop, job, e)
+
+async def _submit_job(audio, language, cache_key=None):
+    """Queue a transcription and wait for its (text, language) result"""
+    future = asyncio.get_running_loop().create_future()
+    await _job_queue.put((audio, language, future, None, cache_key))
+    return await future
+
+async def _submit_streaming_job(audio, language, cache_key=None):
+    """Queue a transcription whose segment texts are pushed to a queue as they're decoded"""
+    stream = asyncio.Queue()
+    await _job_queue.put((audio, language, None, stream, cache_key))
+    return stream
+
+async def _stream_segments(stream, first):
+    """Yield segment texts from a streaming job, space separated, starting with first"""
+    yield first
+    while (item := await stream.get()) is not None:
+        if isinstance(item, Exception):
+            logger.error(f"Transcription failed mid-stream: {item}")
+            raise item
+        yield " " + item
+
 # -----------------------------
 # FastAPI
 # -----------------------------
-app = FastAPI(title="Whisper Assistant API")
+async def _load_model_in_background(app):
+    """Load and warm up the model without holding up the HTTP listener"""
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(executor, preflight_device)
+        model = await loop.run_in_executor(executor, load_whisper_model)
+    except Exception as e:
+        logger.error(f"Failed to load model: {e}", exc_info=True)
+        app.state.model_error = str(e)
+        return
+    await warmup(model)
+    app.state.model = model
+
+@asynccontextmanager
+async def lifespan(app):
+    """Start the batch scheduler and model load; the listener binds while the model loads"""
+    global _job_queue, _batch_worker_task
+    _job_queue = asyncio.Queue()
+    _batch_worker_task = asyncio.create_task(_batch_worker(app))
+    logger.info(f"Batch scheduler started (max batch {MAX_BATCH}, window {BATCH_WINDOW_S * 1000:.0f}ms)")
+    model_loader = asyncio.create_task(_load_model_in_background(app))
+    yield
+    model_loader.cancel()
+    _batch_worker_task.cancel()
+
+class OrjsonResponse(JSONResponse):
+    """JSONResponse rendered with orjson (FastAPI's own ORJSONResponse is deprecated in newer releases)"""
+
+    def render(self, content):
+        return orjson.dumps(content)
+
+app = FastAPI(title="Whisper Assistant API", default_response_class=OrjsonResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -113,40 +556,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# -----------------------------
-# Model load
-# -----------------------------
-logger.info(f"Loading Whisper model: {MODEL_SIZE}")
-try:
-    model = WhisperModel(
-        MODEL_SIZE,
-        device=DEVICE,
-        device_index=DEVICE_INDEX,
-        compute_type=COMPUTE_TYPE,
-        num_workers=1,
-    )
-    logger.info(f"✓ Model loaded successfully: {MODEL_SIZE} on {DEVICE} with {COMPUTE_TYPE}")
-except Exception as e:
-    # Fall back to CPU if CUDA fails
-    if DEVICE == "cuda":
-        logger.warning(f"Failed to load model with CUDA: {e}")
-        logger.info("Falling back to CPU mode...")
-        DEVICE = "cpu"
-        COMPUTE_TYPE = "int8"
-        model = WhisperModel(
-            MODEL_SIZE,
-            device=DEVICE,
-            device_index=DEVICE_INDEX,
-            compute_type=COMPUTE_TYPE,
-            num_workers=1,
-        )
-        logger.info(f"✓ Model loaded successfully: {MODEL_SIZE} on CPU with int8")
-    else:
-        logger.error(f"Failed to load model: {e}")
-        raise
-
-_gpu_lock = asyncio.Lock()
-
 # -----------------------------
 # Routes
 # -----------------------------
@@ -155,91 +564,111 @@ def root():
     return RedirectResponse(url="/docs")
 
 @app.get("/v1/health")
-def health():
+def health(request: Request):
+    model_ready = hasattr(request.app.state, "model")
+    if model_ready:
+        status = "ok"
+    elif hasattr(request.app.state, "model_error"):
+        status = "error"
+    else:
+        status = "loading"
     return {
-        "status": "ok",
+        "status": status,
+        "model_ready": model_ready,
         "device": DEVICE,
         "model": MODEL_SIZE,
         "compute_type": COMPUTE_TYPE,
-        "cuda_available": torch.cuda.is_available(),
-        "cuda_version": getattr(torch.version, "cuda", None),
+        "cuda_available": GPU_INFO["cuda_available"],
+        "cuda_version": GPU_INFO["cuda_version"],
+        "allocated_blocks": sys.getallocatedblocks(),
     }
 
 @app.post("/v1/audio/transcriptions")
 async def transcribe_audio(
+    request: Request,
     file: UploadFile = File(...),
     model_name: str = Form(default="whisper-1"),
     language: Optional[str] = Form(default=None),
     temperature: float = Form(default=0.0),
     response_format: str = Form(default="json"),
 ):
+    if hasattr(request.app.state, "model_error"):
+        raise HTTPException(status_code=500, detail=f"Model failed to load: {request.app.state.model_error}")
+    if not hasattr(request.app.state, "model"):
+        raise HTTPException(status_code=503, detail="Model is still loading, retry shortly")
+
     # Validate file extension
-    suffix = os.path.splitext(file.filename or "")[1].lower() or ".wav"
+    name = file.filename or ""
+    dot_idx = name.rfind(".")
+    suffix = name[dot_idx:].lower() if dot_idx >= 0 else ".wav"
     if suffix not in ALLOWED_AUDIO_EXTENSIONS:
         raise HTTPException(
             status_code=415,
             detail=f"Unsupported audio format: {suffix}. Supported formats: {', '.join(ALLOWED_AUDIO_EXTENSIONS)}"
         )
 
-    # Read file and validate size
-    file_content = await file.read()
-    file_size = len(file_content)
+    # Stream the upload into memory in chunks, rejecting oversized files early
+    buffer = io.BytesIO()
+    hasher = blake3()
+    file_size = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        file_size += len(chunk)
+        if file_size > MAX_FILE_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File too large. Maximum allowed: {MAX_FILE_SIZE / (1024*1024):.0f} MB"
+            )
+        buffer.write(chunk)
+        hasher.update(chunk)
 
-    if file_size > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=413,
-            detail=f"File too large: {file_size / (1024*1024):.1f} MB. Maximum allowed: {MAX_FILE_SIZE / (1024*1024):.0f} MB"
-        )
+    # Large uploads are spooled to a temp file by Starlette; release it now
+    # instead of holding it until the response has been sent
+    await file.close()
 
     if file_size == 0:
         raise HTTPException(status_code=400, detail="Empty file uploaded")
 
-    logger.info(f"Processing transcription: {file.filename} ({file_size / 1024:.1f} KB)")
-
-    tmp_path = None
-    try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp_path = tmp.name
-            tmp.write(file_content)
-            tmp.flush()
-
-        async with _gpu_lock:
-            segments, info = model.transcribe(
-                tmp_path,
-                language=language,
-                # Less aggressive duplicate detection:
-                condition_on_previous_text=True,
-                temperature=0.0,                          # Single temperature, no fallback retries
-                beam_size=1,
-                best_of=1,
-                word_timestamps=False,
-                chunk_length=15,
-                vad_filter=True,
-                vad_parameters={
-                    "min_speech_duration_ms": 200,
-                    "min_silence_duration_ms": 250,
-                    "speech_pad_ms": 120
-                }
-            )
-        
-        text = " ".join(s.text for s in segments).strip()
+    cache_key = (hasher.hexdigest(), language, temperature)
+    cached = cache_get(cache_key)
+    if cached is not None:
+        logger.info(f"Cache hit: {file.filename} ({file_size / 1024:.1f} KB)")
+        buffer.close()
+        text, detected_language = cached
         if response_format == "text":
             return PlainTextResponse(text)
-        return JSONResponse({"text": text, "language": getattr(info, "language", language)})
+        return OrjsonResponse({"text": text, "language": detected_language})
 
+    logger.info(f"Processing transcription: {file.filename} ({file_size / 1024:.1f} KB)")
+
+    try:
+        audio = await asyncio.get_running_loop().run_in_executor(None, decode_audio_buffer, buffer)
+    except Exception as e:
+        logger.warning(f"Could not decode {file.filename}: {e}")
+        raise HTTPException(status_code=400, detail=f"Could not decode audio file: {suffix}")
     finally:
-        if tmp_path and os.path.exists(tmp_path):
-            try:
-                os.unlink(tmp_path)
-            except Exception:
-                pass
+        # The encoded bytes aren't needed once decoded; free them before queueing
+        buffer.close()
+
+    if response_format == "text":
+        # Stream segments as they're decoded to cut time-to-first-byte
+        stream = await _submit_streaming_job(audio, language, cache_key)
+        # Wait for the first segment before committing to a 200, so failures
+        # before any output still surface as an error status
+        first = await stream.get()
+        if isinstance(first, Exception):
+            raise first
+        if first is None:
+            return PlainTextResponse("")
+        return StreamingResponse(_stream_segments(stream, first), media_type="text/plain")
+
+    text, detected_language = await _submit_job(audio, language, cache_key)
+    return OrjsonResponse({"text": text, "language": detected_language})
 
 @app.post("/transcribe")
-async def transcribe_alias(file: UploadFile = File(...), language: Optional[str] = Form(default=None)):
-    return await transcribe_audio(file=file, model_name="whisper-1", language=language, response_format="json")
+async def transcribe_alias(request: Request, file: UploadFile = File(...), language: Optional[str] = Form(default=None)):
+    return await transcribe_audio(request=request, file=file, model_name="whisper-1", language=language, temperature=0.0, response_format="json")
 
-@app.on_event("startup")
-async def warmup():
+async def warmup(model):
     """Warm up the model with a dummy transcription to improve first-request latency"""
     # Log GPU/CUDA configuration
     logger.info("="*60)
@@ -250,107 +679,45 @@ async def warmup():
     logger.info(f"Model: {MODEL_SIZE}")
     logger.info(f"PyTorch Version: {torch.__version__}")
 
-    if torch.cuda.is_available():
+    if GPU_INFO["cuda_available"]:
         logger.info("CUDA Status: Available")
-        try:
-            capability = torch.cuda.get_device_capability(0)
-            compute_cap = float(f"{capability[0]}.{capability[1]}")
-            gpu_name = torch.cuda.get_device_name(0)
-
-            logger.info(f"GPU Name: {gpu_name}")
-            logger.info(f"GPU Compute Capability: sm_{capability[0]}{capability[1]} ({compute_cap})")
-            logger.info(f"CUDA Toolkit Version: {torch.version.cuda}")
-
-            # Explain why CUDA might be disabled
-            pytorch_min_capability = 7.5  # PyTorch 2.9.x requirement
-            logger.info(f"PyTorch Minimum Required: sm_75 (7.5+)")
-
-            if DEVICE == "cuda":
-                logger.info("✓ CUDA ACCELERATION ENABLED")
-                logger.info(f"   GPU is compatible and will be used for acceleration")
-            else:
-                # CUDA is available but not being used - explain why
-                logger.warning("✗ CUDA DISABLED - GPU Not Compatible")
-                logger.warning(f"   Your GPU: {gpu_name} with compute capability {compute_cap} (sm_{capability[0]}{capability[1]})")
+        if "capability" in GPU_INFO:
+            major, minor = GPU_INFO["capability"]
+            logger.info(f"GPU Name: {GPU_INFO['name']}")
+            logger.info(f"GPU Compute Capability: sm_{major}{minor} ({major}.{minor}), {GPU_INFO['architecture']}")
+            logger.info(f"CUDA Toolkit Version: {GPU_INFO['cuda_version']}")
+
+        if DEVICE == "cuda":
+            logger.info("✓ CUDA ACCELERATION ENABLED")
+        else:
+            logger.warning(f"✗ CUDA DISABLED - {GPU_INFO['reason']}")
+            if "capability" in GPU_INFO:
                 logger.warning(f"   PyTorch {torch.__version__} requires: Compute capability 7.5+ (sm_75+)")
-                logger.warning(f"")
-                # Determine GPU architecture based on compute capability
-                if compute_cap >= 9.0:
-                    arch = "Hopper (2022+)"
-                elif compute_cap >= 8.9:
-                    arch = "Ada Lovelace (2022)"
-                elif compute_cap >= 8.0:
-                    arch = "Ampere (2020)"
-                elif compute_cap >= 7.5:
-                    arch = "Turing (2018)"
-                elif compute_cap >= 7.0:
-                    arch = "Volta (2017)"
-                elif compute_cap >= 6.0:
-                    arch = "Pascal (2016)"
-                elif compute_cap >= 5.0:
-                    arch = "Maxwell (2014)"
-                else:
-                    arch = "Kepler or older (2012-)"
-
-                logger.warning(f"   Explanation:")
-                logger.warning(f"   - Your GPU is based on {arch} architecture")
-                logger.warning(f"   - PyTorch 2.9+ dropped support for GPUs older than Turing/Volta (2018)")
-                logger.warning(f"   - Supported GPUs: RTX 20/30/40 series, Tesla V100+, A100, H100")
-                logger.warning(f"")
                 logger.warning(f"   Options:")
                 logger.warning(f"   1. Continue with CPU mode (current - works fine, just slower)")
                 logger.warning(f"   2. Downgrade PyTorch to version 2.4 to use this GPU")
                 logger.warning(f"   3. Upgrade GPU to RTX 2060 or newer for CUDA support")
-
-        except Exception as e:
-            logger.error(f"Error getting GPU details: {e}")
     else:
         logger.info("CUDA Status: Not Available")
-        logger.info("   Possible reasons:")
-        logger.info("   - No NVIDIA GPU detected")
-        logger.info("   - NVIDIA drivers not installed")
-        logger.info("   - PyTorch CPU-only version installed")
 
     logger.info("="*60)
 
-    # Warmup
-    tmp_file = None
+    # Warmup: 15s of low-level noise with the production options, so the first
+    # real request doesn't pay for VAD loading, kernel selection or cuDNN autotuning
     try:
         logger.info("Starting model warmup...")
-        import numpy as np, soundfile as sf
-        import time
-        sr = 16000
-        dummy = np.zeros(sr, dtype="float32")
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as t:
-            tmp_file = t.name
-            sf.write(tmp_file, dummy, sr)
-
-        # File is now closed, safe to read
-        async with _gpu_lock:
-            list(model.transcribe(tmp_file, beam_size=1, vad_filter=False, chunk_length=CHUNK_LENGTH_S))
-
-        # Delete with retry on Windows file lock issues
-        for attempt in range(3):
-            try:
-                if os.path.exists(tmp_file):
-                    os.unlink(tmp_file)
-                    break
-            except PermissionError:
-                if attempt < 2:
-                    time.sleep(0.5)  # Wait before retry
-                else:
-                    logger.warning(f"Could not delete warmup temp file: {tmp_file}")
+        dummy = (np.random.default_rng(0).standard_normal(SAMPLE_RATE * 15) * 0.01).astype("float32")
+        loop = asyncio.get_running_loop()
+
+        # First pass loads VAD. VAD drops most of the noise, so the second pass
+        # disables it to push a full chunk through the encoder and decoder
+        for options in (TRANSCRIBE_OPTIONS, {**TRANSCRIBE_OPTIONS, "vad_filter": False}):
+            await loop.run_in_executor(executor, functools.partial(_transcribe, model, dummy, **options))
 
         logger.info("Model warmup completed successfully")
     except Exception as e:
         logger.error(f"Model warmup failed: {e}", exc_info=True)
         logger.warning("Service will continue, but first transcription request may be slower")
-        # Try to clean up temp file even on error
-        if tmp_file and os.path.exists(tmp_file):
-            try:
-                os.unlink(tmp_file)
-            except:
-                pass
 
 if __name__ == "__main__":
     uvicorn.run("server:app", host=HOST, port=PORT, reload=False, workers=1)
\ No newline at end of file
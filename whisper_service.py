@@ -5,9 +5,13 @@ Signals "running" BEFORE model loads to avoid timeout
 """
 import sys
 import os
+import ctypes
+import shutil
 import threading
 import time
 import logging
+import traceback
+import winreg
 from datetime import datetime
 
 # Add the installation directory to path
@@ -18,6 +22,7 @@ import win32serviceutil
 import win32service
 import win32event
 import servicemanager
+import uvicorn
 
 # Set up file logging
 LOG_DIR = os.path.join(INSTALL_DIR, "logs")
@@ -28,6 +33,38 @@ STDERR_LOG = os.path.join(LOG_DIR, "stderr.log")
 
 MAX_LOG_LINES = 10000  # Keep only last 10000 lines
 
+# Only the override build replaces the CRT heap; plain mimalloc.dll does not
+MIMALLOC_OVERRIDE_DLL = "mimalloc-override.dll"
+
+def detect_allocator():
+    """Describe the process heap allocator (mimalloc if its override DLL is loaded)"""
+    try:
+        kernel32 = ctypes.WinDLL("kernel32")
+        kernel32.GetModuleHandleW.restype = ctypes.c_void_p
+        if kernel32.GetModuleHandleW(MIMALLOC_OVERRIDE_DLL):
+            return f"mimalloc ({MIMALLOC_OVERRIDE_DLL})"
+    except Exception as e:
+        return f"unknown ({e})"
+    return "default (CRT heap)"
+
+LOG_TAIL_BLOCK_SIZE = 64 * 1024  # Read size when scanning a log backwards
+
+def read_tail_lines(f, max_lines):
+    """Return the last max_lines lines of a binary file, reading backwards in blocks"""
+    pos = f.seek(0, os.SEEK_END)
+    blocks = []
+    newlines = 0
+    # One extra newline guarantees the first kept line is complete
+    while pos > 0 and newlines <= max_lines:
+        read_size = min(LOG_TAIL_BLOCK_SIZE, pos)
+        pos -= read_size
+        f.seek(pos)
+        block = f.read(read_size)
+        newlines += block.count(b"\n")
+        blocks.append(block)
+    lines = b"".join(reversed(blocks)).splitlines(keepends=True)
+    return b"".join(lines[-max_lines:])
+
 def cleanup_log_file(log_path, max_lines=MAX_LOG_LINES):
     """Truncate log file to keep only the last N lines"""
     try:
@@ -41,16 +78,28 @@ def cleanup_log_file(log_path, max_lines=MAX_LOG_LINES):
         if file_size < 1024 * 1024:
             return
 
-        with open(log_path, 'r', encoding='utf-8', errors='ignore') as f:
-            lines = f.readlines()
+        with open(log_path, 'rb') as f:
+            tail = read_tail_lines(f, max_lines)
 
-        if len(lines) > max_lines:
-            removed_lines = len(lines) - max_lines
-            # Keep only last max_lines
-            with open(log_path, 'w', encoding='utf-8') as f:
-                f.write(f"[Log truncated on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - removed {removed_lines} old lines, kept last {max_lines} lines]\n")
-                f.writelines(lines[-max_lines:])
-            print(f"Truncated {log_path}: {file_size_mb:.1f}MB, removed {removed_lines} lines")
+        if len(tail) >= file_size:
+            return
+
+        removed_mb = (file_size - len(tail)) / (1024 * 1024)
+        header = f"[Log truncated on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - removed {removed_mb:.1f}MB of old lines, kept last {max_lines} lines]\n"
+        tmp_path = log_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(header.encode('utf-8'))
+            f.write(tail)
+
+        try:
+            os.replace(tmp_path, log_path)
+        except PermissionError:
+            # Windows refuses to replace a file that is open elsewhere (e.g. by a
+            # logging.FileHandler), so fall back to rewriting it in place
+            with open(tmp_path, 'rb') as src, open(log_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(tmp_path)
+        print(f"Truncated {log_path}: {file_size_mb:.1f}MB, removed {removed_mb:.1f}MB")
     except Exception as e:
         # Don't fail service startup if log cleanup fails
         print(f"Warning: Could not cleanup log file {log_path}: {e}")
@@ -77,6 +126,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+SERVER_START_TIMEOUT = 30  # Seconds to wait for uvicorn to bind before reporting anyway
+
+
+class SignalingServer(uvicorn.Server):
+    """uvicorn server that sets an event once its sockets are listening"""
+
+    def __init__(self, config, ready):
+        super().__init__(config)
+        self.ready = ready
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        if self.started:
+            self.ready.set()
+
 
 class WhisperAPIService(win32serviceutil.ServiceFramework):
     _svc_name_ = "whisper-api"
@@ -89,6 +153,7 @@ class WhisperAPIService(win32serviceutil.ServiceFramework):
         self.is_running = False
         self.server_thread = None
         self.log_cleanup_thread = None
+        self.server_ready = threading.Event()
 
     def SvcStop(self):
         """Called when the service is requested to stop"""
@@ -104,6 +169,7 @@ class WhisperAPIService(win32serviceutil.ServiceFramework):
         msg = f"{self._svc_display_name_} - Starting service"
         logger.info(msg)
         logger.info(f"Log file: {LOG_FILE}")
+        logger.info(f"Memory allocator: {detect_allocator()}")
         servicemanager.LogInfoMsg(msg)
 
         # Report that we're starting
@@ -121,31 +187,15 @@ class WhisperAPIService(win32serviceutil.ServiceFramework):
             self.log_cleanup_thread.start()
             logger.info("Started periodic log cleanup thread (runs every hour)")
 
-            # Wait for the server to become healthy
-            host = os.getenv("WHISPER_HOST", "127.0.0.1")
-            port = int(os.getenv("WHISPER_PORT", "4444"))
-            health_url = f"http://{host}:{port}/v1/health"
-
-            logger.info(f"Waiting for server to become healthy at {health_url}...")
-            start_time = time.time()
-            max_wait = 30  # 30 seconds max wait
-
-            while time.time() - start_time < max_wait:
-                try:
-                    import urllib.request
-                    with urllib.request.urlopen(health_url, timeout=1) as response:
-                        if response.status == 200:
-                            logger.info("Server health check passed")
-                            break
-                except Exception:
-                    time.sleep(0.5)
+            # Wait for uvicorn to start listening (set by SignalingServer.startup)
+            if self.server_ready.wait(timeout=SERVER_START_TIMEOUT):
+                logger.info("Server is listening")
             else:
-                # Timeout reached, but continue anyway (server may still be loading model)
-                logger.warning(f"Server health check timeout after {max_wait}s, continuing anyway")
+                logger.warning(f"Server did not start listening within {SERVER_START_TIMEOUT}s, continuing anyway")
 
             # IMPORTANT: Signal to Windows that we're running NOW
-            # This happens BEFORE the model loads (which happens in server.py warmup)
-            # Windows gets the "running" signal immediately, avoiding timeout
+            # The model loads in the background (server.py lifespan) and /v1/health
+            # reports "loading" until it is ready
             self.ReportServiceStatus(win32service.SERVICE_RUNNING)
             msg = f"{self._svc_display_name_} - Service is running (model will load in background)"
             logger.info(msg)
@@ -188,7 +238,6 @@ class WhisperAPIService(win32serviceutil.ServiceFramework):
         """Run the FastAPI/uvicorn server - this includes model loading warmup"""
         try:
             # Load environment variables from registry before importing server
-            import winreg
             try:
                 key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE,
                                     f"SYSTEM\\CurrentControlSet\\Services\\{self._svc_name_}\\Environment",
@@ -208,7 +257,6 @@ class WhisperAPIService(win32serviceutil.ServiceFramework):
             except Exception as e:
                 logger.error(f"Error loading environment variables from registry: {e}")
 
-            import uvicorn
             from server import app
 
             # Get configuration from environment or defaults
@@ -219,7 +267,7 @@ class WhisperAPIService(win32serviceutil.ServiceFramework):
             logger.info(msg)
             servicemanager.LogInfoMsg(msg)
 
-            msg = "Model will load during FastAPI startup event (warmup)"
+            msg = "Model will load in the background after the listener starts"
             logger.info(msg)
             servicemanager.LogInfoMsg(msg)
 
@@ -231,9 +279,8 @@ class WhisperAPIService(win32serviceutil.ServiceFramework):
             logger.info(f"Redirecting stderr to: {stderr_log}")
 
             # Run uvicorn - this blocks until server shuts down
-            # The server.py @app.on_event("startup") warmup() will run here
-            # This can take 30+ seconds, but Windows already thinks we're "running"
-            uvicorn.run(
+            # The model load and warmup run as a background task in server.py's lifespan
+            config = uvicorn.Config(
                 app,
                 host=host,
                 port=port,
@@ -260,9 +307,9 @@ class WhisperAPIService(win32serviceutil.ServiceFramework):
                     },
                 }
             )
+            SignalingServer(config, self.server_ready).run()
 
         except Exception as e:
-            import traceback
             error_detail = traceback.format_exc()
             msg = f"Failed to start server: {str(e)}\n{error_detail}"
             logger.error(msg)